@@ -13,30 +13,37 @@ Flask API + 画面表示アプリ
 """
 
 from flask import (
-    Flask, request, jsonify,
+    Flask, Response, request, jsonify, make_response,
     render_template, redirect, url_for, flash, session as flask_session
 )
+from flask.json.provider import JSONProvider
 from flask_jwt_extended import (
-    JWTManager, jwt_required,
+    jwt_required,
     create_access_token, get_jwt_identity, get_jwt
 )
-from sqlalchemy import select, func, and_, or_
-from datetime import datetime, timedelta
+from werkzeug.exceptions import HTTPException
+from sqlalchemy import (
+    select, insert, update, func, and_, or_, cast, literal, extract, Integer, Text
+)
+from sqlalchemy.dialects.postgresql import aggregate_order_by, insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import selectinload, raiseload, load_only
+from datetime import timedelta
+import jinja2
+import orjson
+from cachetools import TTLCache
+import functools
 import logging
+import threading
 
-from db import get_session, get_session_context
+from db import engine, db_session
 from models import User, Station, Battery, Rental
-from auth import hash_password, verify_password
+from auth import hash_password, verify_password, CachingJWTManager
 from variables import (
     JWT_SECRET_KEY, PRICE_PER_MINUTE_CENTS, RENTAL_DEPOSIT_CENTS,
-    INITIAL_BALANCE_CENTS, DEBUG_MODE
+    INITIAL_BALANCE_CENTS, DEBUG_MODE, STATION_CACHE_TTL_SECONDS
 )
 
-# --------------------
-# Flask 初期化
-# --------------------
-app = Flask(__name__)
-
 import os
 
 # ====================
@@ -59,27 +66,56 @@ if os.getenv("RESET_DB_ONCE") == "true" and not os.path.exists(RESET_FLAG_FILE):
 # --------------------
 app = Flask(__name__)
 
-# データベースの初期化
-with app.app_context():
-    from db import engine
-    from models import Base
-    Base.metadata.create_all(bind=engine)
-
-
-
 # データベースの初期化（テーブルがなければ作成する）
 with app.app_context():
-    from db import engine
+    from db import engine, ensure_indexes
     from models import Base
     # ここでSQLを流し込まなくても、models.pyの定義を元にテーブルを自動作成します
     Base.metadata.create_all(bind=engine)
+    # 既存テーブルに後から追加したインデックス（複合インデックス等）も作成する
+    ensure_indexes()
 
 app.config["JWT_SECRET_KEY"] = JWT_SECRET_KEY
 app.config["SECRET_KEY"] = "change_me_in_production_123!"  # HTMLフォーム用
 app.config["JWT_ACCESS_TOKEN_EXPIRES"] = timedelta(hours=1)
 app.config["DEBUG"] = DEBUG_MODE
+# テンプレート変更の監視は開発時のみ
+app.config["TEMPLATES_AUTO_RELOAD"] = DEBUG_MODE
+
+# 本番ではコンパイル済みテンプレートをファイルにキャッシュし、
+# ワーカー再起動後もテンプレートの再パースを省く
+if not DEBUG_MODE:
+    app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache()
+
+class OrjsonProvider(JSONProvider):
+    """jsonify / request.get_json の JSON 変換を orjson（C 実装）で行う"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # bytes のまま渡して str への変換・再エンコードを省く
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC),
+            mimetype="application/json"
+        )
+
+app.json = OrjsonProvider(app)
+
+jwt = CachingJWTManager(app)
+
+@jwt.user_identity_loader
+def user_identity_lookup(user_id):
+    """JWT の sub クレームは文字列である必要があるため、ユーザーIDを文字列化"""
+    return str(user_id)
 
-jwt = JWTManager(app)
+def current_user_id():
+    """JWT の sub（文字列）をユーザーID（int）に戻す"""
+    return int(get_jwt_identity())
 
 @app.context_processor
 def inject_template_globals():
@@ -93,36 +129,388 @@ def inject_template_globals():
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# ====================
+# リクエスト単位のセッション
+# ====================
+
+# 1リクエストで1つのセッション（db_session）を使い回す（読み取り処理・ヘルパーで共有）
+# セッションは最初に使われたときに作られる
+
+@app.teardown_appcontext
+def remove_db_session(exc):
+    """リクエスト終了時に commit（例外時は rollback）してセッションを破棄"""
+    try:
+        if exc is None:
+            db_session.commit()
+        else:
+            db_session.rollback()
+    finally:
+        db_session.remove()
+
+# ====================
+# HTTP キャッシュ
+# ====================
+
+# 数秒間はクライアントのキャッシュをそのまま使わせるエンドポイント（全員共通のスタンド一覧）
+CACHEABLE_API_ENDPOINTS = {"api_stations"}
+# 毎回再検証させるエンドポイント
+# （残高など、そのクライアント自身の貸出・返却・チャージですぐ変わる内容を含む）
+REVALIDATED_ENDPOINTS = {"api_user", "home_page", "stations_page", "station_detail_page"}
+
+@app.after_request
+def add_cache_headers(response):
+    """
+    読み取り系 GET に Cache-Control と ETag を付与し、変化がなければ 304 を返す
+    - スタンド一覧 API: 5秒間はクライアント側のキャッシュをそのまま使わせる
+    - ユーザー情報 API・画面: 残高やフラッシュメッセージが変わるため毎回再検証させる
+    """
+    if request.method != "GET" or response.status_code != 200:
+        return response
+    if request.endpoint in CACHEABLE_API_ENDPOINTS:
+        response.headers["Cache-Control"] = "private, max-age=5"
+    elif request.endpoint in REVALIDATED_ENDPOINTS:
+        response.headers["Cache-Control"] = "private, no-cache"
+    else:
+        return response
+    response.add_etag(weak=True)
+    return response.make_conditional(request)
+
 # ====================
 # ヘルパー関数
 # ====================
 
-def get_user_balance(user_id):
+def eager(query, *options):
+    """
+    クエリに読み込み戦略（joinedload 等）を付与する
+    DEBUG_MODE では raiseload('*') も付与し、指定漏れのリレーションへの
+    遅延ロード（N+1 の原因）を例外として検出する
+    """
+    if DEBUG_MODE:
+        options += (raiseload("*"),)
+    return query.options(*options) if options else query
+
+def get_user_balance(user_id, session=None):
     """ユーザー残高を取得（SQLAlchemy ORM使用）"""
-    with get_session_context() as session:
-        user = session.get(User, user_id)
-        return user.balance_cents if user else 0
-
-def get_available_batteries_count(station_id):
-    """指定スタンドの利用可能バッテリー数を取得（JOINクエリ）"""
-    with get_session_context() as session:
-        count = session.query(func.count(Battery.id)).filter(
-            Battery.station_id == station_id,
-            Battery.available == True
+    session = session or db_session
+    user = session.get(User, user_id)
+    return user.balance_cents if user else 0
+
+# 金額として受け付ける最大桁数（DB の INTEGER の範囲に収める）
+MAX_AMOUNT_DIGITS = 9
+
+def parse_amount(value):
+    """
+    金額入力を int に変換する（整数でない・桁数が多すぎる場合は None）
+    例外を使わずに判定するため、文字列は isdecimal() と桁数で確認してから int() する
+    （isdecimal() は全角数字も True になり、int() もそれを受け付ける）
+    （桁数を先に確認しないと、4300 桁を超える文字列で int() が ValueError になる）
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        if abs(value) >= 10 ** MAX_AMOUNT_DIGITS:
+            return None
+        return value
+    if isinstance(value, str):
+        value = value.strip()
+        if len(value) <= MAX_AMOUNT_DIGITS and value.isdecimal():
+            return int(value)
+    return None
+
+def get_login_row(email, session=None):
+    """ログイン判定に必要な列だけを取得（email は UNIQUE インデックスで検索）"""
+    session = session or db_session
+    return session.execute(
+        select(User.id, User.email, User.password_hash, User.balance_cents)
+        .where(User.email == email)
+    ).first()
+
+# スタンド一覧 + 利用可能数のキャッシュ（数秒で失効、貸出・返却時にも破棄）
+_station_cache = TTLCache(maxsize=2, ttl=STATION_CACHE_TTL_SECONDS)
+_station_cache_lock = threading.Lock()
+
+def invalidate_station_cache():
+    """貸出・返却でバッテリーの空き状況が変わったらキャッシュを破棄"""
+    with _station_cache_lock:
+        _station_cache.clear()
+
+def station_counts_query():
+    """スタンドごとの利用可能バッテリー数（LEFT JOIN + GROUP BY の1クエリ）"""
+    # COUNT(...) FILTER (WHERE ...) は該当行が無ければ 0 になる（COALESCE 不要）
+    available_count = (
+        func.count(Battery.id).filter(Battery.available == True)
+    ).label("available_count")
+    return (
+        select(Station.id, Station.name, Station.location, available_count)
+        .outerjoin(Battery, Battery.station_id == Station.id)
+        .group_by(Station.id)
+    )
+
+def get_stations_with_counts(session=None):
+    """
+    全スタンドと利用可能バッテリー数を取得
+    画面で使う列だけを SELECT し、ORM オブジェクトは生成しない
+    結果は _station_cache に保持し、TTL 内は DB に問い合わせない
+    """
+    with _station_cache_lock:
+        cached = _station_cache.get("stations")
+    if cached is not None:
+        return cached
+
+    session = session or db_session
+    rows = session.execute(station_counts_query()).all()
+    station_data = [
+        {
+            "id": row.id,
+            "name": row.name,
+            "location": row.location,
+            "available_count": row.available_count
+        }
+        for row in rows
+    ]
+    with _station_cache_lock:
+        _station_cache["stations"] = station_data
+    return station_data
+
+def get_stations_json(session=None):
+    """
+    API 用のスタンド一覧を JSON 文字列のまま取得
+    JSON の組み立ては DB 側で行う（SQLite: json_group_array / PostgreSQL: json_agg）
+    結果は get_stations_with_counts と同じく _station_cache に保持する
+    """
+    with _station_cache_lock:
+        cached = _station_cache.get("stations_json")
+    if cached is not None:
+        return cached
+
+    session = session or db_session
+    counts = station_counts_query().subquery()
+    fields = (
+        "id", counts.c.id,
+        "name", counts.c.name,
+        "location", counts.c.location,
+        "available", counts.c.available_count,
+    )
+    if engine.dialect.name == "postgresql":
+        # json 型のまま返すとドライバが Python オブジェクトに変換するため text にする
+        array = func.coalesce(
+            cast(func.json_agg(aggregate_order_by(
+                func.json_build_object(*fields), counts.c.id
+            )), Text),
+            literal("[]")
+        )
+    else:
+        # SQLite の json_group_array は 0 行でも '[]' を返す
+        array = func.json_group_array(func.json_object(*fields))
+    stations_json = session.execute(select(array)).scalar_one()
+
+    with _station_cache_lock:
+        _station_cache["stations_json"] = stations_json
+    return stations_json
+
+# strftime 形式 → PostgreSQL の to_char 形式
+PG_DATETIME_FORMATS = {
+    "%Y-%m-%d %H:%M": "YYYY-MM-DD HH24:MI",
+    "%Y-%m-%dT%H:%M:%S": 'YYYY-MM-DD"T"HH24:MI:SS',
+}
+
+def format_datetime_sql(column, fmt):
+    """日時の文字列整形を DB 側で行う式（SQLite: strftime / PostgreSQL: to_char）"""
+    if engine.dialect.name == "postgresql":
+        return func.to_char(column, PG_DATETIME_FORMATS[fmt])
+    return func.strftime(fmt, column)
+
+def rental_minutes_sql(start_column):
+    """
+    貸出開始から現在までの利用分数を DB 側で計算する式（切り捨て・最低1分）
+    現在時刻も DB の時計を使う（SQLite: strftime('%s') / PostgreSQL: extract(epoch)）
+    """
+    if engine.dialect.name == "postgresql":
+        minutes = cast(func.floor(extract("epoch", func.now() - start_column) / 60), Integer)
+        return func.greatest(minutes, 1)
+    seconds = (
+        cast(func.strftime("%s", "now"), Integer)
+        - cast(func.strftime("%s", start_column), Integer)
+    )
+    return func.max(seconds // 60, 1)
+
+# 履歴画面の1ページあたりの件数と、受け付けるページ番号の上限
+# （上限がないと巨大な OFFSET が DB の整数範囲を超えてエラーになる）
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE = 10000
+
+def get_user_rentals_with_details(user_id, limit=None, offset=0, session=None):
+    """
+    ユーザーの貸出履歴を取得（バッテリー・スタンドは selectinload で一括取得）
+    画面表示用に開始・終了日時を DB 側で整形した列も一緒に返す
+    limit / offset を指定するとその範囲だけ取得する（ページ送り用）
+    → (Rental, start_at_str, end_at_str) の行
+    """
+    session = session or db_session
+    # joinedload だと履歴の各行にバッテリー・スタンドの列が重複して載るため、
+    # 履歴が長いユーザーほど転送量が増える。selectinload なら
+    # 「履歴 → battery_id IN (...) → station_id IN (...)」の固定3クエリで、
+    # 関連行は重複なく1回ずつ取得できる
+    stmt = eager(
+        select(
+            Rental,
+            format_datetime_sql(Rental.start_at, "%Y-%m-%d %H:%M"),
+            format_datetime_sql(Rental.end_at, "%Y-%m-%d %H:%M")
+        ),
+        selectinload(Rental.battery).selectinload(Battery.station)
+    ).where(
+        Rental.user_id == user_id
+    ).order_by(
+        Rental.start_at.desc(), Rental.id.desc()
+    ).limit(limit).offset(offset)
+    return session.execute(stmt).all()
+
+def get_user_history_rows(user_id, session=None):
+    """
+    ユーザーの貸出履歴を API で返す列だけ取得（Rental + シリアル + スタンド名）
+    開始・終了日時は DB 側で ISO 8601 形式の文字列にする
+    """
+    session = session or db_session
+    stmt = select(
+        Rental.id,
+        format_datetime_sql(Rental.start_at, "%Y-%m-%dT%H:%M:%S").label("start_at"),
+        format_datetime_sql(Rental.end_at, "%Y-%m-%dT%H:%M:%S").label("end_at"),
+        Rental.price_cents, Rental.status,
+        Battery.serial, Station.name.label("station_name")
+    ).outerjoin(
+        Battery, Rental.battery_id == Battery.id
+    ).outerjoin(
+        Station, Battery.station_id == Station.id
+    ).where(
+        Rental.user_id == user_id
+    ).order_by(Rental.start_at.desc())
+    return session.execute(stmt).all()
+
+def rent_battery(user_id, battery_id, session=None):
+    """
+    貸出処理（バッテリーを貸出中にして貸出レコードを作成）
+    - 残高チェックは UPDATE の WHERE にサブクエリで含め、成功時は2文で終わる
+    - 失敗したときだけ原因（貸出不可 / 残高不足）を調べる
+    戻り値: (rental_id, None) または (None, エラーメッセージ)
+    """
+    session = session or db_session
+    balance = select(User.balance_cents).where(User.id == user_id).scalar_subquery()
+    rented = session.execute(
+        update(Battery)
+        .where(
+            Battery.id == battery_id,
+            Battery.available == True,
+            balance >= RENTAL_DEPOSIT_CENTS
+        )
+        .values(available=False)
+        .returning(Battery.id)
+    ).first()
+    if rented is None:
+        available = session.execute(
+            select(Battery.available).where(Battery.id == battery_id)
         ).scalar()
-        return count or 0
-
-def get_user_rentals_with_details(user_id):
-    """ユーザーの貸出履歴を取得（JOINクエリでバッテリー情報も取得）"""
-    with get_session_context() as session:
-        rentals = session.query(Rental, Battery, Station).join(
-            Battery, Rental.battery_id == Battery.id
-        ).outerjoin(
-            Station, Battery.station_id == Station.id
-        ).filter(
-            Rental.user_id == user_id
-        ).order_by(Rental.start_at.desc()).all()
-        return rentals
+        if not available:
+            return None, "battery not available"
+        return None, "insufficient balance"
+
+    rental_id = session.execute(
+        insert(Rental)
+        .values(user_id=user_id, battery_id=battery_id, status="ongoing")
+        .returning(Rental.id)
+    ).scalar_one()
+    return rental_id, None
+
+def return_rental(user_id, rental_id, return_station_id=None, session=None):
+    """
+    返却処理（貸出終了 + 料金の引き落とし + バッテリーを利用可能に戻す）
+    - 利用時間・料金は DB 側で計算し、UPDATE ... RETURNING で受け取る
+    - 残高不足なら引き落としの UPDATE が0行になる（呼び出し側でロールバックすること）
+    - return_station_id を指定するとバッテリーをそのスタンドへ移す
+    戻り値: (price, balance, None) または (None, None, エラーメッセージ)
+    """
+    session = session or db_session
+    returned = session.execute(
+        update(Rental)
+        .where(
+            Rental.id == rental_id,
+            Rental.user_id == user_id,
+            Rental.status == "ongoing"
+        )
+        .values(
+            end_at=func.now(),
+            status="returned",
+            price_cents=rental_minutes_sql(Rental.start_at) * PRICE_PER_MINUTE_CENTS
+        )
+        .returning(Rental.battery_id, Rental.price_cents)
+    ).first()
+    if returned is None:
+        return None, None, "invalid rental"
+
+    price = returned.price_cents
+    balance = session.execute(
+        update(User)
+        .where(User.id == user_id, User.balance_cents >= price)
+        .values(balance_cents=User.balance_cents - price)
+        .returning(User.balance_cents)
+    ).scalar_one_or_none()
+    if balance is None:
+        return None, None, "insufficient balance"
+
+    values = {"available": True}
+    if return_station_id:
+        values["station_id"] = return_station_id
+    session.execute(
+        update(Battery).where(Battery.id == returned.battery_id).values(**values)
+    )
+    return price, balance, None
+
+def charge_balance(user_id, amount, session=None):
+    """
+    チャージ処理（残高に amount を加算）
+    - SELECT せずに UPDATE ... RETURNING の1文で加算する（同時チャージでも取りこぼさない）
+    戻り値: 加算後の残高（ユーザーが存在しなければ None）
+    """
+    session = session or db_session
+    return session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(balance_cents=User.balance_cents + amount)
+        .returning(User.balance_cents)
+    ).scalar_one_or_none()
+
+def transactional(error_msg, invalidates_stations=False):
+    """
+    API の書き込み処理用デコレーター
+    - リクエスト単位のセッション（db_session）を session 引数で渡す
+    - 正常応答（ステータス < 400）なら commit、エラー応答・例外なら rollback
+    - 例外はログに残し、error_msg の JSON（500）を返す
+      （HTTPException は rollback して再送出し、本来のステータス（400/415 等）で返す）
+    - invalidates_stations=True なら commit 後にスタンド一覧キャッシュを破棄
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            session = db_session
+            try:
+                response = make_response(fn(*args, session=session, **kwargs))
+                if response.status_code >= 400:
+                    session.rollback()
+                    return response
+                session.commit()
+            except HTTPException:
+                # 不正な JSON など、リクエスト側の誤りは 500 にしない
+                session.rollback()
+                raise
+            except Exception as e:
+                session.rollback()
+                logger.error(f"API {fn.__name__} failed: {e}")
+                return jsonify({"msg": error_msg}), 500
+
+            if invalidates_stations:
+                invalidate_station_cache()
+            return response
+        return wrapper
+    return decorator
 
 # ====================
 # 画面ルーティング
@@ -155,106 +543,94 @@ def register_page():
         flash("パスワードが一致しません", "error")
         return render_template("register.html"), 400
 
-    with get_session_context() as session:
-        try:
-            # トランザクション開始
-            with session.begin():
-                # メール重複チェック（SELECT）
-                existing_user = session.query(User).filter_by(email=email).first()
-                if existing_user:
-                    flash("このメールアドレスは既に登録されています", "error")
-                    return render_template("register.html"), 400
-
-                # ユーザー作成（INSERT）
-                user = User(
-                    email=email,
-                    password_hash=hash_password(password),
-                    balance_cents=INITIAL_BALANCE_CENTS
-                )
-                session.add(user)
-                session.flush()  # IDを取得するためにflush
-
-
-            logger.info(f"User {email} registered with initial balance {INITIAL_BALANCE_CENTS}")
-            flash("登録が完了しました。ログインしてください", "success")
-            return redirect(url_for("login_page"))
+    try:
+        # ユーザー作成（INSERT ... ON CONFLICT DO NOTHING RETURNING）
+        # 事前の重複 SELECT は行わず、一意制約で弾かれたら ID が返らない
+        dialect_insert = pg_insert if engine.dialect.name == "postgresql" else sqlite_insert
+        user_id = db_session.execute(
+            dialect_insert(User)
+            .values(
+                email=email,
+                password_hash=hash_password(password),
+                balance_cents=INITIAL_BALANCE_CENTS
+            )
+            .on_conflict_do_nothing(index_elements=[User.email])
+            .returning(User.id)
+        ).scalar()
+        if user_id is None:
+            flash("このメールアドレスは既に登録されています", "error")
+            return render_template("register.html"), 400
+        db_session.commit()
 
-        except Exception as e:
-            logger.error(f"Registration failed for {email}: {e}")
-            flash("登録に失敗しました。時間をおいて再度お試しください", "error")
-            return render_template("register.html"), 500
+    except Exception as e:
+        db_session.rollback()
+        logger.error(f"Registration failed for {email}: {e}")
+        flash("登録に失敗しました。時間をおいて再度お試しください", "error")
+        return render_template("register.html"), 500
 
-@app.route("/home", strict_slashes=False)
+    logger.info(f"User {email} registered with initial balance {INITIAL_BALANCE_CENTS}")
+    flash("登録が完了しました。ログインしてください", "success")
+    return redirect(url_for("login_page"))
+
+@app.route("/home", methods=["GET"], strict_slashes=False)
 def home_page():
     """ホーム画面"""
     user_id = flask_session.get("user_id")
     if not user_id:
         return redirect(url_for("login_page"))
 
-    with get_session_context() as session:
-        # 全スタンド取得（SELECT）
-        stations = session.query(Station).all()
-        
-        # 各スタンドの利用可能バッテリー数を計算
-        station_data = []
-        for station in stations:
-            available_count = get_available_batteries_count(station.id)
-            station_data.append({
-                "id": station.id,
-                "name": station.name,
-                "location": station.location,
-                "available_count": available_count
-            })
-
-        # ユーザー残高取得
-        balance = get_user_balance(user_id)
+    # 全スタンド + 利用可能バッテリー数（GROUP BY の1クエリ）
+    station_data = get_stations_with_counts()
+
+    # ユーザー残高取得（同じセッションで取得）
+    balance = get_user_balance(user_id)
 
     return render_template("home.html", 
                          stations=station_data, 
                          balance=balance,
                          user_id=user_id)
 
-@app.route("/stations", strict_slashes=False)
+@app.route("/stations", methods=["GET"], strict_slashes=False)
 def stations_page():
     """スタンド一覧画面"""
     user_id = flask_session.get("user_id")
     if not user_id:
         return redirect(url_for("login_page"))
 
-    with get_session_context() as session:
-        stations = session.query(Station).all()
-        station_data = []
-        for station in stations:
-            available_count = get_available_batteries_count(station.id)
-            station_data.append({
-                "id": station.id,
-                "name": station.name,
-                "location": station.location,
-                "available_count": available_count
-            })
+    station_data = get_stations_with_counts()
 
     return render_template("stations.html", stations=station_data)
 
-@app.route("/stations/<int:station_id>", strict_slashes=False)
+@app.route("/stations/<int:station_id>", methods=["GET"], strict_slashes=False)
 def station_detail_page(station_id):
     """スタンド詳細画面（利用可能バッテリー一覧）"""
     user_id = flask_session.get("user_id")
     if not user_id:
         return redirect(url_for("login_page"))
 
-    with get_session_context() as session:
-        station = session.get(Station, station_id)
-        if not station:
-            flash("指定されたスタンドは存在しません", "error")
-            return redirect(url_for("stations_page"))
-
-        # そのスタンドの利用可能��ッテリーを取得（JOINクエリ）
-        batteries = session.query(Battery).filter(
-            Battery.station_id == station_id,
-            Battery.available == True
-        ).all()
-
-        balance = get_user_balance(user_id)
+    session = db_session
+    # スタンドと利用可能バッテリーを LEFT JOIN の1クエリで取得
+    # バッテリーは画面で使う列だけを読み込む（extra_info 等は読まない）
+    rows = session.execute(
+        eager(
+            select(Station, Battery)
+            .outerjoin(Battery, and_(
+                Battery.station_id == Station.id,
+                Battery.available == True
+            ))
+            .where(Station.id == station_id)
+            .order_by(Battery.id),
+            load_only(Battery.id, Battery.serial, Battery.battery_level)
+        )
+    ).all()
+    if not rows:
+        flash("指定されたスタンドは存在しません", "error")
+        return redirect(url_for("stations_page"))
+
+    station = rows[0].Station
+    batteries = [row.Battery for row in rows if row.Battery is not None]
+
+    balance = get_user_balance(user_id, session)
 
     return render_template("station_detail.html", 
                          station=station, 
@@ -268,46 +644,39 @@ def rent_page(battery_id):
     if not user_id:
         return redirect(url_for("login_page"))
 
-    with get_session_context() as session:
-        battery = session.get(Battery, battery_id)
-        if not battery or not battery.available:
-            flash("このバッテリーは貸出できません", "error")
-            return redirect(url_for("stations_page"))
-
-        user = session.get(User, user_id)
-        if user.balance_cents < RENTAL_DEPOSIT_CENTS:
-            flash("残高が不足しています。チャージしてください", "error")
-            return redirect(url_for("charge_page"))
+    battery = db_session.get(Battery, battery_id)
+    if not battery or not battery.available:
+        flash("このバッテリーは貸出できません", "error")
+        return redirect(url_for("stations_page"))
 
-        balance = user.balance_cents
+    balance = get_user_balance(user_id)
+    if balance < RENTAL_DEPOSIT_CENTS:
+        flash("残高が不足しています。チャージしてください", "error")
+        return redirect(url_for("charge_page"))
 
     if request.method == "POST":
         # 貸出処理（トランザクション）
         try:
-            with get_session_context() as session:
-                with session.begin():
-                    user = session.get(User, user_id)
-                    battery = session.get(Battery, battery_id)
-
-                    if not battery or not battery.available:
-                        return jsonify({"msg": "battery not available"}), 400
-
-                    if user.balance_cents < RENTAL_DEPOSIT_CENTS:
-                        return jsonify({"msg": "insufficient balance"}), 400
-
-                    # 貸出レコード作成（INSERT）
-                    rental = Rental(
-                        user_id=user.id,
-                        battery_id=battery.id,
-                        status="ongoing"
-                    )
-                    battery.available = False
-                    session.add(rental)
+            # 空き・残高を条件付き UPDATE で確認しつつ貸出（二重貸出を防ぐ）
+            _, error = rent_battery(user_id, battery_id)
+            if error:
+                db_session.rollback()
+            else:
+                db_session.commit()
+
+            if error == "battery not available":
+                flash("このバッテリーは貸出できません", "error")
+                return redirect(url_for("stations_page"))
+            if error == "insufficient balance":
+                flash("残高が不足しています。チャージしてください", "error")
+                return redirect(url_for("charge_page"))
 
+            invalidate_station_cache()
             flash("バッテリーを貸出しました", "success")
             return redirect(url_for("home_page"))
 
         except Exception as e:
+            db_session.rollback()
             logger.error(f"Rent failed for user {user_id}, battery {battery_id}: {e}")
             flash("貸出に失敗しました", "error")
             return redirect(url_for("rent_page", battery_id=battery_id))
@@ -321,62 +690,52 @@ def return_page(rental_id):
     if not user_id:
         return redirect(url_for("login_page"))
 
-    with get_session_context() as session:
-        rental = session.get(Rental, rental_id)
-        if not rental or rental.user_id != user_id or rental.status != "ongoing":
-            flash("返却できません", "error")
-            return redirect(url_for("history_page"))
+    session = db_session
+    rental = session.get(Rental, rental_id)
+    if not rental or rental.user_id != user_id or rental.status != "ongoing":
+        flash("返却できません", "error")
+        return redirect(url_for("history_page"))
 
-        battery = session.get(Battery, rental.battery_id)
-        station = session.get(Station, battery.station_id) if battery else None
+    battery = session.get(Battery, rental.battery_id)
+    station = session.get(Station, battery.station_id) if battery else None
 
     # ここからは関数内部にあるべき処理なのでインデントを関数内に揃える
     if request.method == "POST":
         try:
-            with get_session_context() as session:
-                with session.begin():
-                    rental = session.get(Rental, rental_id)
-                    battery = session.get(Battery, rental.battery_id)
-                    user = session.get(User, user_id)
-
-                    # 時間・料金計算
-                    end_time = datetime.utcnow()
-                    start_time = rental.start_at
-                    minutes = max(1, int((end_time - start_time).total_seconds() // 60))
-                    price = minutes * PRICE_PER_MINUTE_CENTS
-
-                    # 残高チェック
-                    if user.balance_cents < price:
-                        flash("残高が不足しています", "error")
-                        return redirect(url_for("charge_page"))
-
-                    # 返却先ステーション
-                    return_station_id = request.form.get("return_station_id")
-
-                    # 返却処理（UPDATE）
-                    user.balance_cents -= price
-                    rental.end_at = end_time
-                    rental.price_cents = price
-                    rental.status = "returned"
-
-                    battery.available = True
-
-                    # ★ ここが重要（位置更新）
-                    if return_station_id:
-                        battery.station_id = int(return_station_id)
+            # 返却先ステーション（★ バッテリーの位置も更新する）
+            return_station_id = request.form.get("return_station_id")
+            return_station_id = int(return_station_id) if return_station_id else None
+
+            price, _, error = return_rental(
+                user_id, rental_id, return_station_id, session
+            )
+            if error:
+                session.rollback()
+            else:
+                session.commit()
+
+            if error == "insufficient balance":
+                flash("残高が不足しています", "error")
+                return redirect(url_for("charge_page"))
+            if error:
+                flash("返却できません", "error")
+                return redirect(url_for("history_page"))
 
+            invalidate_station_cache()
             flash(f"バッテリーを返却しました。料金: {price}円", "success")
             return redirect(url_for("home_page"))
 
         except Exception as e:
+            session.rollback()
             logger.error(f"Return failed for rental {rental_id}: {e}")
             flash("返却に失敗しました", "error")
             return redirect(url_for("return_page", rental_id=rental_id))
 
-    with get_session_context() as session:
-        stations = session.query(Station).all()
+    stations = session.execute(
+        select(Station.id, Station.name, Station.location)
+    ).all()
 
-    return render_template("return.html", 
+    return render_template("return.html",
                          rental=rental, 
                          battery=battery, 
                          station=station,
@@ -389,25 +748,38 @@ def history_page():
     if not user_id:
         return redirect(url_for("login_page"))
 
-    rentals_data = get_user_rentals_with_details(user_id)
-    
-    # 履歴データを整形
+    # 1ページ分 + 1件を取得し、次のページがあるかを判定する
+    page = request.args.get("page", 1, type=int)
+    if not 1 <= page <= HISTORY_MAX_PAGE:
+        return redirect(url_for("history_page"))
+    rentals_data = get_user_rentals_with_details(
+        user_id,
+        limit=HISTORY_PAGE_SIZE + 1,
+        offset=(page - 1) * HISTORY_PAGE_SIZE
+    )
+    has_next = len(rentals_data) > HISTORY_PAGE_SIZE
+    rentals_data = rentals_data[:HISTORY_PAGE_SIZE]
+
+    # 履歴データを整形（日時は DB 側で文字列化済み）
     history_list = []
-    for rental, battery, station in rentals_data:
-        start_time = rental.start_at.strftime("%Y-%m-%d %H:%M")
-        end_time = rental.end_at.strftime("%Y-%m-%d %H:%M") if rental.end_at else "貸出中"
-        
+    for rental, start_at, end_at in rentals_data:
+        battery = rental.battery
+        station = battery.station if battery else None
+
         history_list.append({
             "id": rental.id,
-            "start_at": start_time,
-            "end_at": end_time,
+            "start_at": start_at,
+            "end_at": end_at or "貸出中",
             "battery_serial": battery.serial if battery else "不明",
             "station_name": station.name if station else "不明",
             "price": rental.price_cents if rental.price_cents else 0,
             "status": rental.status
         })
 
-    return render_template("history.html", history=history_list)
+    return render_template("history.html",
+                         history=history_list,
+                         page=page,
+                         has_next=has_next)
 
 @app.route("/charge", methods=["GET", "POST"], strict_slashes=False)
 def charge_page():
@@ -418,35 +790,25 @@ def charge_page():
 
     if request.method == "POST":
         # フォーム入力を安全にパース
-        amount_str = (request.form.get("amount") or "").strip()
-        try:
-            amount = int(amount_str)
-        except (ValueError, TypeError):
-            flash("有効な金額を入力してください", "error")
-            return redirect(url_for("charge_page"))
-
-        if amount <= 0:
+        amount = parse_amount(request.form.get("amount"))
+        if amount is None or amount <= 0:
             flash("有効な金額を入力してください", "error")
             return redirect(url_for("charge_page"))
 
         try:
-            with get_session_context() as session:
-                with session.begin():
-                    user = session.get(User, user_id)
-                    if not user:
-                        # 想定外（セッションに user_id があるが DB にユーザーがない）
-                        raise RuntimeError("ユーザーが見つかりません")
-
-                    # 単位に注意: 変数名に _CENTS がついていてもテンプレートは「円」を表示しています。
-                    # このアプリでは amount をそのまま balance_cents に足す実装になっています。
-                    user.balance_cents += amount
-
-
+            # 単位に注意: 変数名に _CENTS がついていてもテンプレートは「円」を表示しています。
+            # このアプリでは amount をそのまま balance_cents に足す実装になっています。
+            balance = charge_balance(user_id, amount)
+            if balance is None:
+                # 想定外（セッションに user_id があるが DB にユーザーがない）
+                raise RuntimeError("ユーザーが見つかりません")
+            db_session.commit()
 
             flash(f"{amount}円をチャージしました", "success")
             return redirect(url_for("home_page"))
 
         except Exception as e:
+            db_session.rollback()
             # トレースをログに残す（Render のログで確認可能）
             logger.exception(f"Charge failed for user {user_id}: {e}")
             if DEBUG_MODE:
@@ -479,18 +841,17 @@ def api_login():
     if not email or not password:
         return jsonify({"msg": "email and password required"}), 400
 
-    with get_session_context() as session:
-        user = session.query(User).filter_by(email=email).first()
-        if not user or not verify_password(password, user.password_hash):
-            return jsonify({"msg": "bad credentials"}), 401
-
-        token = create_access_token(identity=user.id)
-        return jsonify({
-            "access_token": token,
-            "user_id": user.id,
-            "email": user.email,
-            "balance": user.balance_cents
-        })
+    user = get_login_row(email)
+    if not user or not verify_password(password, user.password_hash):
+        return jsonify({"msg": "bad credentials"}), 401
+
+    token = create_access_token(identity=user.id)
+    return jsonify({
+        "access_token": token,
+        "user_id": user.id,
+        "email": user.email,
+        "balance": user.balance_cents
+    })
 
 @app.route("/login", methods=["GET", "POST"], strict_slashes=False)
 def login_page():
@@ -507,176 +868,118 @@ def login_page():
         flash("メールアドレスとパスワードを入力してください", "error")
         return render_template("login.html"), 400
 
-    with get_session_context() as session:
-        user = session.query(User).filter_by(email=email).first()
-        if not user or not verify_password(password, user.password_hash):
-            flash("メールアドレスまたはパスワードが間違っています", "error")
-            return render_template("login.html"), 401
+    user = get_login_row(email)
+    if not user or not verify_password(password, user.password_hash):
+        flash("メールアドレスまたはパスワードが間違っています", "error")
+        return render_template("login.html"), 401
 
-        access_token = create_access_token(identity=user.id)
-        flask_session["user_id"] = user.id
-        flask_session["access_token"] = access_token
+    access_token = create_access_token(identity=user.id)
+    flask_session["user_id"] = user.id
+    flask_session["access_token"] = access_token
 
-        logger.info(f"User {user.email} logged in")
-        return redirect(url_for("home_page"))
+    logger.info(f"User {user.email} logged in")
+    return redirect(url_for("home_page"))
 
 @app.route("/api/stations", methods=["GET"], strict_slashes=False)
 def api_stations():
     """API: スタンド一覧"""
-    with get_session_context() as session:
-        stations = session.query(Station).all()
-        result = []
-        for s in stations:
-            available = get_available_batteries_count(s.id)
-            result.append({
-                "id": s.id,
-                "name": s.name,
-                "location": s.location,
-                "available": available
-            })
-        return jsonify(result)
+    return Response(get_stations_json(), mimetype="application/json")
 
 @app.route("/api/rent", methods=["POST"], strict_slashes=False)
 @jwt_required()
-def api_rent():
+@transactional("rental failed", invalidates_stations=True)
+def api_rent(session):
     """API: 貸出"""
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     data = request.get_json() or {}
     battery_id = data.get("battery_id")
 
     if not battery_id:
         return jsonify({"msg": "battery_id required"}), 400
 
-    try:
-        with get_session_context() as session:
-            with session.begin():
-                user = session.get(User, user_id)
-                battery = session.get(Battery, battery_id)
-
-                if not battery or not battery.available:
-                    return jsonify({"msg": "battery not available"}), 400
-
-                if user.balance_cents < RENTAL_DEPOSIT_CENTS:
-                    return jsonify({"msg": "insufficient balance"}), 400
-
-                rental = Rental(
-                    user_id=user.id,
-                    battery_id=battery.id,
-                    status="ongoing"
-                )
-                battery.available = False
-                session.add(rental)
-
-        return jsonify({"msg": "rented", "rental_id": rental.id})
-    except Exception as e:
-        logger.error(f"API rent failed: {e}")
-        return jsonify({"msg": "rental failed"}), 500
+    rental_id, error = rent_battery(user_id, battery_id, session)
+    if error:
+        return jsonify({"msg": error}), 400
+
+    return jsonify({"msg": "rented", "rental_id": rental_id})
 
 @app.route("/api/return", methods=["POST"], strict_slashes=False)
 @jwt_required()
-def api_return():
+@transactional("return failed", invalidates_stations=True)
+def api_return(session):
     """API: 返却"""
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     data = request.get_json() or {}
     rental_id = data.get("rental_id")
 
     if not rental_id:
         return jsonify({"msg": "rental_id required"}), 400
 
-    try:
-        with get_session_context() as session:
-            with session.begin():
-                rental = session.get(Rental, rental_id)
-                if not rental or rental.user_id != user_id or rental.status != "ongoing":
-                    return jsonify({"msg": "invalid rental"}), 400
-
-                battery = session.get(Battery, rental.battery_id)
-                user = session.get(User, user_id)
-
-                end_time = datetime.utcnow()
-                start_time = rental.start_at
-                minutes = max(1, int((end_time - start_time).total_seconds() // 60))
-                price = minutes * PRICE_PER_MINUTE_CENTS
-
-                if user.balance_cents < price:
-                    return jsonify({"msg": "insufficient balance"}), 400
-
-                user.balance_cents -= price
-                rental.end_at = end_time
-                rental.price_cents = price
-                rental.status = "returned"
-                battery.available = True
-
-        return jsonify({
-            "msg": "returned", 
-            "price": price,
-            "balance": user.balance_cents
-        })
-    except Exception as e:
-        logger.error(f"API return failed: {e}")
-        return jsonify({"msg": "return failed"}), 500
+    # エラー応答なので途中までの更新はロールバックされる
+    price, balance, error = return_rental(user_id, rental_id, session=session)
+    if error:
+        return jsonify({"msg": error}), 400
+
+    return jsonify({
+        "msg": "returned", 
+        "price": price,
+        "balance": balance
+    })
 
 @app.route("/api/charge", methods=["POST"], strict_slashes=False)
 @jwt_required()
-def api_charge():
+@transactional("charge failed")
+def api_charge(session):
     """API: チャージ"""
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     data = request.get_json() or {}
-    amount = int(data.get("amount", 0))
+    amount = parse_amount(data.get("amount"))
 
-    if amount <= 0:
+    if amount is None or amount <= 0:
         return jsonify({"msg": "invalid amount"}), 400
 
-    try:
-        with get_session_context() as session:
-            with session.begin():
-                user = session.get(User, user_id)
-                user.balance_cents += amount
-
+    balance = charge_balance(user_id, amount, session)
+    if balance is None:
+        return jsonify({"msg": "user not found"}), 404
 
-
-        return jsonify({
-            "msg": "charged", 
-            "balance": user.balance_cents
-        })
-    except Exception as e:
-        logger.error(f"API charge failed: {e}")
-        return jsonify({"msg": "charge failed"}), 500
+    return jsonify({
+        "msg": "charged", 
+        "balance": balance
+    })
 
 @app.route("/api/user", methods=["GET"], strict_slashes=False)
 @jwt_required()
 def api_user():
     """API: ユーザー情報取得"""
-    user_id = get_jwt_identity()
-    with get_session_context() as session:
-        user = session.get(User, user_id)
-        if not user:
-            return jsonify({"msg": "user not found"}), 404
-
-        return jsonify({
-            "id": user.id,
-            "email": user.email,
-            "balance": user.balance_cents,
-            "created_at": user.created_at.isoformat()
-        })
+    user_id = current_user_id()
+    user = db_session.get(User, user_id)
+    if not user:
+        return jsonify({"msg": "user not found"}), 404
+
+    return jsonify({
+        "id": user.id,
+        "email": user.email,
+        "balance": user.balance_cents,
+        "created_at": user.created_at.isoformat()
+    })
 
 @app.route("/api/history", methods=["GET"], strict_slashes=False)
 @jwt_required()
 def api_history():
     """API: 利用履歴取得"""
-    user_id = get_jwt_identity()
-    rentals_data = get_user_rentals_with_details(user_id)
-    
+    user_id = current_user_id()
+    rows = get_user_history_rows(user_id)
+
     history = []
-    for rental, battery, station in rentals_data:
+    for row in rows:
         history.append({
-            "id": rental.id,
-            "start_at": rental.start_at.isoformat(),
-            "end_at": rental.end_at.isoformat() if rental.end_at else None,
-            "battery_serial": battery.serial if battery else None,
-            "station_name": station.name if station else None,
-            "price": rental.price_cents if rental.price_cents else 0,
-            "status": rental.status
+            "id": row.id,
+            "start_at": row.start_at,
+            "end_at": row.end_at,
+            "battery_serial": row.serial,
+            "station_name": row.station_name,
+            "price": row.price_cents if row.price_cents else 0,
+            "status": row.status
         })
 
     return jsonify(history)
@@ -702,5 +1005,6 @@ if __name__ == "__main__":
     if DEBUG_MODE:
         app.logger.setLevel(logging.DEBUG)
     
+    # 開発用サーバー。本番は gunicorn app:app（gevent ワーカー、gunicorn.conf.py 参照）
     app.run(debug=DEBUG_MODE, host="0.0.0.0", port=5000)
 
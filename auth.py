@@ -1,3 +1,11 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+from cachetools import TLRUCache, TTLCache
+from flask_jwt_extended import JWTManager
 from passlib.context import CryptContext
 
 pwd_context = CryptContext(
@@ -5,8 +13,83 @@ pwd_context = CryptContext(
     deprecated="auto"
 )
 
+# 検証に成功した（パスワード, ハッシュ）の組を短時間だけ覚えておき、
+# 同じ端末からの再ログインでハッシュ計算を省く
+# - キーはプロセスごとの乱数鍵による HMAC（平文パスワードは保持しない）
+# - 保存済みハッシュもキーに含めるため、パスワード変更で自然に無効になる
+# - 失敗した検証はキャッシュしない
+VERIFIED_CACHE_TTL_SECONDS = 300
+_verified_cache = TTLCache(maxsize=1024, ttl=VERIFIED_CACHE_TTL_SECONDS)
+_verified_cache_lock = threading.Lock()
+_verified_cache_key = os.urandom(32)
+
+def _verified_key(password: str, hashed: str) -> bytes:
+    message = f"{hashed}\0{password}".encode()
+    return hmac.new(_verified_cache_key, message, hashlib.sha256).digest()
+
+def _run_blocking(fn, *args):
+    """
+    CPU を使う処理を実行する
+    gevent で monkey patch されたワーカーではハブのスレッドプールで実行し、
+    計算中も同じワーカーの他のリクエスト（グリーンレット）を止めない
+    （pbkdf2 は hashlib の C 実装で GIL を解放するため、実際に並行に動く）
+    """
+    try:
+        from gevent import get_hub, monkey
+    except ImportError:
+        return fn(*args)
+    if not monkey.is_module_patched("threading"):
+        return fn(*args)
+    return get_hub().threadpool.apply(fn, args)
+
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    return _run_blocking(pwd_context.hash, password)
 
 def verify_password(password: str, hashed: str) -> bool:
-    return pwd_context.verify(password, hashed)
+    key = _verified_key(password, hashed)
+    with _verified_cache_lock:
+        if _verified_cache.get(key):
+            return True
+
+    if not _run_blocking(pwd_context.verify, password, hashed):
+        return False
+
+    with _verified_cache_lock:
+        _verified_cache[key] = True
+    return True
+
+# デコード済みの JWT クレームをトークンごとに覚えておき、
+# 同じトークンでの2回目以降は署名検証・JSON パースを省く
+# - キーはトークンの blake2b ダイジェスト（トークン本体は保持しない）
+# - 各エントリはトークンの exp か上限 TTL のどちらか早い方で失効する
+# - 検証に失敗したトークンはキャッシュしない
+DECODED_JWT_CACHE_MAX_TTL_SECONDS = 300
+
+def _decoded_jwt_expires_at(_key, claims, now):
+    return min(claims.get("exp", now), now + DECODED_JWT_CACHE_MAX_TTL_SECONDS)
+
+class CachingJWTManager(JWTManager):
+    """JWT のデコード結果をキャッシュする JWTManager"""
+
+    def __init__(self, app=None, **kwargs):
+        self._decoded_cache = TLRUCache(
+            maxsize=10_000, ttu=_decoded_jwt_expires_at, timer=time.time
+        )
+        self._decoded_cache_lock = threading.Lock()
+        super().__init__(app, **kwargs)
+
+    def _decode_jwt_from_config(self, encoded_token, csrf_value=None, allow_expired=False):
+        # CSRF 検証や期限切れ許可を伴う呼び出しは毎回まともに検証する
+        if csrf_value is not None or allow_expired:
+            return super()._decode_jwt_from_config(encoded_token, csrf_value, allow_expired)
+
+        key = hashlib.blake2b(encoded_token.encode(), digest_size=16).digest()
+        with self._decoded_cache_lock:
+            claims = self._decoded_cache.get(key)
+        if claims is not None:
+            return dict(claims)
+
+        claims = super()._decode_jwt_from_config(encoded_token)
+        with self._decoded_cache_lock:
+            self._decoded_cache[key] = claims
+        return dict(claims)
@@ -19,24 +19,63 @@ finally:
 =====================================================
 """
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.schema import CreateIndex
 from contextlib import contextmanager
 
-from variables import DATABASE_URL
+from variables import DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE
 from models import Base
 
 # ============================================================
 # エンジン作成
 # - echo=True: 発行されるSQLをコンソールに表示（デバッグ用）
 # - future=True: SQLAlchemy 2.0スタイルを使用
+# - executemany_mode（psycopg2のみ）: 複数行の INSERT/UPDATE を
+#   まとめて送信し、ネットワーク往復回数を減らす
+#   （PostgreSQL の URL は variables.py で psycopg2 に固定している。
+#    +psycopg を明示した場合はドライバ側でパイプライン化されるため指定不要）
+# - プール設定（SQLite 以外）: gevent ワーカーでは1プロセスが多数の
+#   リクエストを同時に扱うため、既定（5 + 10）より大きめに確保する
+#   pool_pre_ping で切断済みの接続を使う前に検知する
 # ============================================================
+database_url = make_url(DATABASE_URL)
+engine_options = {}
+if database_url.get_driver_name() == "psycopg2":
+    engine_options["executemany_mode"] = "values_plus_batch"
+if database_url.get_backend_name() != "sqlite":
+    engine_options.update(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_pre_ping=True,
+        pool_recycle=DB_POOL_RECYCLE,
+    )
+
 engine = create_engine(
     DATABASE_URL,
     echo=True,  # SQLログ出力（授業で見せる用）
-    future=True
+    future=True,
+    **engine_options
 )
 
+# ============================================================
+# SQLite 用の PRAGMA（接続ごとに設定）
+# - journal_mode=WAL: 書き込み中も読み取りをブロックしない
+# - synchronous=NORMAL: WAL ではコミットごとの fsync を省いても安全
+# - mmap_size: ページ読み込みをメモリマップで行う（256MB）
+# - temp_store=MEMORY: 一時テーブル・ソートをメモリ上で行う
+# ============================================================
+if database_url.get_backend_name() == "sqlite":
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
 # ============================================================
 # セッションファクトリ
 # - expire_on_commit=False: コミット後もオブジェクトにアクセス可能
@@ -49,6 +88,13 @@ SessionLocal = sessionmaker(
     future=True
 )
 
+# ============================================================
+# リクエスト単位のセッション（Web アプリ用）
+# - スレッド（gevent ではグリーンレット）ごとに1つのセッションを使い回す
+# - リクエスト終了時に db_session.remove() で片付けること（app.py 参照）
+# ============================================================
+db_session = scoped_session(SessionLocal)
+
 
 def get_session():
     """
@@ -91,9 +137,26 @@ def init_db():
     - 本番ではマイグレーションツール（Alembic）推奨
     """
     Base.metadata.create_all(bind=engine)
+    ensure_indexes()
     print("✅ データベーステーブルを作成しました")
 
 
+def ensure_indexes():
+    """
+    models.py で定義したインデックスのうち、DB に無いものを作成する
+
+    【注意】
+    - create_all は既存テーブルのインデックスを追加しないため、
+      後から追加したインデックスはこれで既存 DB（本番・mobile_battery.db）に反映する
+    - CREATE INDEX IF NOT EXISTS なので何度実行してもよい
+      （複数ワーカーが同時に起動しても「既に存在する」エラーにならない）
+    """
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                conn.execute(CreateIndex(index, if_not_exists=True))
+
+
 def drop_all_tables():
     """
     全テーブル削除（開発用）
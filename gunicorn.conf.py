@@ -0,0 +1,35 @@
+"""
+gunicorn.conf.py - 本番用 gunicorn 設定
+=====================================================
+【起動方法】
+gunicorn app:app
+（このファイルはカレントディレクトリから自動で読み込まれる）
+
+【設計意図】
+- ハンドラーのほとんどは DB 待ちなので、gevent ワーカーで
+  1ワーカーあたり多数のリクエストを協調的に並行処理する
+- gevent ワーカーは起動時に標準ライブラリを monkey patch するため、
+  app.py 側で patch_all() を呼ぶ必要はない
+- bind は未指定（gunicorn が環境変数 PORT を自動で使う）
+=====================================================
+"""
+
+import os
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+
+
+def post_fork(server, worker):
+    # psycopg2 は C 拡張で待機するため、gevent に制御を返すよう設定する
+    # （SQLite など psycopg2 を使わない構成では psycogreen を読み込まない）
+    if worker_class != "gevent":
+        return
+
+    from sqlalchemy.engine import make_url
+    from variables import DATABASE_URL
+
+    if make_url(DATABASE_URL).get_driver_name() == "psycopg2":
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
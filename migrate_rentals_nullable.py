@@ -15,8 +15,8 @@ battery_id を NULL 許容に変更して置き換えるスクリプト
 """
 import os
 import sys
-import shutil
 import sqlite3
+from contextlib import closing
 from urllib.parse import urlparse
 
 # try to import DATABASE_URL from your variables.py
@@ -44,6 +44,12 @@ def get_sqlite_path_from_url(url: str):
     # fallback (rare)
     return url[len("sqlite://"):]
 
+def backup_sqlite(src_path: str, dst_path: str):
+    # SQLite のオンラインバックアップ API でコピーする
+    # (ファイルコピーと違い、アプリが書き込み中でも整合性のあるスナップショットになる)
+    with closing(sqlite3.connect(src_path)) as src, closing(sqlite3.connect(dst_path)) as dst:
+        src.backup(dst, pages=1024)
+
 DB_PATH = get_sqlite_path_from_url(DATABASE_URL)
 if not DB_PATH:
     print("DATABASE_URL is not SQLite or cannot determine path. DATABASE_URL:", DATABASE_URL)
@@ -59,7 +65,7 @@ if not os.path.exists(DB_PATH):
 
 bak = DB_PATH + ".bak"
 print("Backing up DB to:", bak)
-shutil.copyfile(DB_PATH, bak)
+backup_sqlite(DB_PATH, bak)
 
 conn = sqlite3.connect(DB_PATH)
 c = conn.cursor()
@@ -70,6 +76,15 @@ try:
         print(row)
     print("Beginning migration...")
 
+    # コピーを速くするための PRAGMA（トランザクション開始前に設定する）
+    # - journal_mode=WAL / synchronous=NORMAL: アプリ（db.py）と同じ設定。コミット時の fsync を減らす
+    # - temp_store=MEMORY: 一時データをメモリ上で扱う
+    # - cache_size=-200000: ページキャッシュを約 200MB にする（このコネクションのみ）
+    c.execute("PRAGMA journal_mode = WAL;")
+    c.execute("PRAGMA synchronous = NORMAL;")
+    c.execute("PRAGMA temp_store = MEMORY;")
+    c.execute("PRAGMA cache_size = -200000;")
+
     c.execute("PRAGMA foreign_keys = OFF;")
     c.execute("BEGIN TRANSACTION;")
 
@@ -89,14 +104,24 @@ try:
     """)
 
     # Copy data. If your original rentals has extra columns, you must include them here.
+    # id 順に挿入して、新テーブルの B-tree へ末尾追加で書き込む
     c.execute("""
     INSERT INTO rentals_new (id, user_id, battery_id, start_at, end_at, status, price_cents)
-      SELECT id, user_id, battery_id, start_at, end_at, status, price_cents FROM rentals;
+      SELECT id, user_id, battery_id, start_at, end_at, status, price_cents FROM rentals
+      ORDER BY id;
     """)
 
     c.execute("DROP TABLE rentals;")
     c.execute("ALTER TABLE rentals_new RENAME TO rentals;")
 
+    # DROP TABLE で旧テーブルのインデックスも消えるため作り直す
+    # （コピー後にまとめて作る方が、1行ずつインデックスを更新するより速い）
+    # models.py のインデックス定義と名前・列を合わせること
+    c.execute("CREATE INDEX IF NOT EXISTS ix_rentals_user_id ON rentals (user_id);")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_rentals_battery_id ON rentals (battery_id);")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_rentals_status ON rentals (status);")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_rentals_user_id_start_at ON rentals (user_id, start_at DESC);")
+
     c.execute("COMMIT;")
     c.execute("PRAGMA foreign_keys = ON;")
     print("Migration completed successfully.")
@@ -106,7 +131,7 @@ except Exception as e:
     conn.rollback()
     print("Migration failed:", e)
     print("Restoring backup...")
-    shutil.copyfile(bak, DB_PATH)
+    backup_sqlite(bak, DB_PATH)
     print("Backup restored.")
     raise
 finally:
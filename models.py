@@ -1,6 +1,6 @@
 from sqlalchemy import (
     Column, Integer, String, Boolean, ForeignKey,
-    DateTime, Float, Text, func
+    DateTime, Float, Text, Index, func
 )
 from sqlalchemy.orm import relationship, declarative_base
 
@@ -65,6 +65,13 @@ class Rental(Base):
     battery = relationship("Battery", back_populates="rentals")
 
 
+# 複合インデックス
+# - スタンドごとの利用可能数（station_id + available）をインデックスだけで数える
+# - ユーザーの履歴（user_id + start_at DESC）を並べ替えなしで取り出す
+Index("ix_batteries_station_id_available", Battery.station_id, Battery.available)
+Index("ix_rentals_user_id_start_at", Rental.user_id, Rental.start_at.desc())
+
+
 class ChargeHistory(Base):
     __tablename__ = "charge_histories"
 
@@ -0,0 +1,17 @@
+"""
+pytest 共通設定
+- テストは drop_all / create_all でテーブルを作り直すため、
+  リポジトリの mobile_battery.db ではなく一時ディレクトリの SQLite を使う
+- db.py は import 時にエンジンを作るので、各テストが db を import する前に DATABASE_URL を差し替える
+  （load_dotenv は既存の環境変数を上書きしないため .env より優先される）
+"""
+import os
+import shutil
+import tempfile
+
+_tmp_dir = tempfile.mkdtemp(prefix="mobile_battery_test_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp_dir, 'test.db')}"
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(_tmp_dir, ignore_errors=True)
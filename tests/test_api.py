@@ -0,0 +1,165 @@
+"""
+JSON API の pytest テスト
+- /api/login で発行したトークンをそのまま使い、JWT 保護された API を叩く
+SQLite のまま動かす想定
+"""
+import pytest
+from datetime import datetime, timedelta, timezone
+from db import engine, get_session
+from models import Base, User, Station, Battery, Rental
+from app import app
+from auth import hash_password
+from variables import PRICE_PER_MINUTE_CENTS
+
+@pytest.fixture(scope="module")
+def client():
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    s = get_session()
+    s.add(User(email="api@example.com", password_hash=hash_password("pass"), balance_cents=5000))
+    s.add(User(email="broke@example.com", password_hash=hash_password("pass"), balance_cents=0))
+    st = Station(name="A1", location="L1", lat=0.0, lng=0.0)
+    s.add(st)
+    s.commit()
+    s.add(Battery(serial="API1", station_id=st.id, available=True))
+    s.commit()
+    s.close()
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        yield client
+
+@pytest.fixture(scope="module")
+def headers(client):
+    r = client.post("/api/login", json={"email": "api@example.com", "password": "pass"})
+    assert r.status_code == 200
+    return {"Authorization": f"Bearer {r.get_json()['access_token']}"}
+
+def test_user(client, headers):
+    r = client.get("/api/user", headers=headers)
+    assert r.status_code == 200
+    assert r.get_json()["balance"] == 5000
+
+def test_stations(client):
+    r = client.get("/api/stations")
+    assert r.status_code == 200
+    assert r.mimetype == "application/json"
+    assert r.get_json() == [{"id": 1, "name": "A1", "location": "L1", "available": 1}]
+
+def login_headers(client, email):
+    r = client.post("/api/login", json={"email": email, "password": "pass"})
+    return {"Authorization": f"Bearer {r.get_json()['access_token']}"}
+
+def seed_ongoing_rental(email, balance_cents, minutes):
+    """start_at を minutes 分（+20秒）前にした貸出中レコードを作る → rental_id"""
+    s = get_session()
+    u = User(email=email, password_hash=hash_password("pass"), balance_cents=balance_cents)
+    b = Battery(serial=f"BILL-{email}", station_id=1, available=False)
+    s.add_all([u, b])
+    s.commit()
+    start_at = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(minutes=minutes, seconds=20)
+    rental = Rental(user_id=u.id, battery_id=b.id, status="ongoing", start_at=start_at)
+    s.add(rental)
+    s.commit()
+    rental_id = rental.id
+    s.close()
+    return rental_id
+
+def get_rental(rental_id):
+    s = get_session()
+    rental = s.get(Rental, rental_id)
+    s.close()
+    return rental
+
+def test_return_charges_elapsed_minutes(client):
+    rental_id = seed_ongoing_rental("bill@example.com", 1000, minutes=7)
+    headers = login_headers(client, "bill@example.com")
+
+    r = client.post("/api/return", json={"rental_id": rental_id}, headers=headers)
+    assert r.status_code == 200
+    price = 7 * PRICE_PER_MINUTE_CENTS
+    assert r.get_json()["price"] == price
+    assert r.get_json()["balance"] == 1000 - price
+    assert client.get("/api/user", headers=headers).get_json()["balance"] == 1000 - price
+
+    rental = get_rental(rental_id)
+    assert rental.status == "returned"
+    assert rental.price_cents == price
+    assert rental.end_at is not None
+
+def test_return_insufficient_balance_rolls_back(client):
+    balance = 7 * PRICE_PER_MINUTE_CENTS - 1
+    rental_id = seed_ongoing_rental("short@example.com", balance, minutes=7)
+    headers = login_headers(client, "short@example.com")
+
+    r = client.post("/api/return", json={"rental_id": rental_id}, headers=headers)
+    assert r.status_code == 400
+    assert r.get_json()["msg"] == "insufficient balance"
+    assert client.get("/api/user", headers=headers).get_json()["balance"] == balance
+
+    # 貸出レコードの更新もロールバックされ、貸出中のまま
+    rental = get_rental(rental_id)
+    assert rental.status == "ongoing"
+    assert rental.end_at is None
+    assert rental.price_cents is None
+
+def test_rent_rejects_malformed_json(client, headers):
+    r = client.post(
+        "/api/rent", data="{not json", content_type="application/json", headers=headers
+    )
+    assert r.status_code == 400
+    r = client.post("/api/charge", data="amount=1", headers=headers)
+    assert r.status_code == 415
+
+def test_rent_insufficient_balance(client):
+    broke = login_headers(client, "broke@example.com")
+    r = client.post("/api/rent", json={"battery_id": 1}, headers=broke)
+    assert r.status_code == 400
+    assert r.get_json()["msg"] == "insufficient balance"
+
+def test_rent_and_return(client, headers):
+    r = client.post("/api/rent", json={"battery_id": 1}, headers=headers)
+    assert r.status_code == 200
+    rental_id = r.get_json()["rental_id"]
+
+    r = client.post("/api/rent", json={"battery_id": 1}, headers=headers)
+    assert r.status_code == 400
+
+    r = client.post("/api/return", json={"rental_id": rental_id}, headers=headers)
+    assert r.status_code == 200
+    assert r.get_json()["msg"] == "returned"
+
+    r = client.get("/api/history", headers=headers)
+    assert r.status_code == 200
+    row = r.get_json()[0]
+    assert row["status"] == "returned"
+    assert "T" in row["start_at"] and "T" in row["end_at"]
+
+def test_tampered_token_is_rejected(client, headers):
+    # 正しいトークンがキャッシュ済みでも、改ざんされたトークンは通さない
+    assert client.get("/api/user", headers=headers).status_code == 200
+    token = headers["Authorization"]
+    bad = {"Authorization": token[:-2] + ("AA" if not token.endswith("AA") else "BB")}
+    assert client.get("/api/user", headers=bad).status_code in (401, 422)
+
+def test_charge(client):
+    headers = login_headers(client, "broke@example.com")
+    r = client.post("/api/charge", json={"amount": 300}, headers=headers)
+    assert r.status_code == 200
+    assert r.get_json()["balance"] == 300
+    r = client.post("/api/charge", json={"amount": -1}, headers=headers)
+    assert r.status_code == 400
+
+def test_user_is_revalidated_after_charge(client, headers):
+    r = client.get("/api/user", headers=headers)
+    assert r.headers["Cache-Control"] == "private, no-cache"
+    etag = r.headers["ETag"]
+    balance = r.get_json()["balance"]
+
+    client.post("/api/charge", json={"amount": 100}, headers=headers)
+    r = client.get("/api/user", headers={**headers, "If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.get_json()["balance"] == balance + 100
+
+def test_stations_short_max_age(client):
+    r = client.get("/api/stations")
+    assert r.headers["Cache-Control"] == "private, max-age=5"
@@ -0,0 +1,141 @@
+"""
+画面表示の pytest テスト
+- DEBUG_MODE では raiseload('*') が有効なため、
+  テンプレートやヘルパーでの遅延ロード（N+1）があればここで例外になる
+SQLite のまま動かす想定
+"""
+import pytest
+from sqlalchemy import inspect, text
+from db import engine, get_session, ensure_indexes
+from models import Base, User, Station, Battery, Rental
+from app import app, HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE
+from auth import hash_password
+
+@pytest.fixture(scope="module")
+def client():
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    s = get_session()
+    u = User(email="page@example.com", password_hash=hash_password("pass"), balance_cents=5000)
+    s.add(u)
+    s.commit()
+    st1 = Station(name="S1", location="L1", lat=0.0, lng=0.0)
+    st2 = Station(name="S2", location="L2", lat=0.0, lng=0.0)
+    s.add_all([st1, st2])
+    s.commit()
+    b1 = Battery(serial="PAGE1", station_id=st1.id, available=True)
+    b2 = Battery(serial="PAGE2", station_id=st1.id, available=False)
+    s.add_all([b1, b2])
+    s.commit()
+    s.add(Rental(user_id=u.id, battery_id=b2.id, status="ongoing"))
+    s.commit()
+    user_id = u.id
+    s.close()
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess["user_id"] = user_id
+        yield client
+
+def test_home_counts_available_batteries(client):
+    r = client.get("/home")
+    assert r.status_code == 200
+    body = r.get_data(as_text=True)
+    assert "1台 利用可能" in body
+    assert "¥5000" in body
+
+def test_station_pages(client):
+    r = client.get("/stations")
+    assert r.status_code == 200
+    r = client.get("/stations/1")
+    assert r.status_code == 200
+    body = r.get_data(as_text=True)
+    assert "PAGE1" in body
+    assert "PAGE2" not in body
+    r = client.get("/stations/2")
+    assert r.status_code == 200
+    assert "利用可能なバッテリーがありません" in r.get_data(as_text=True)
+    r = client.get("/stations/999")
+    assert r.status_code == 302
+
+def test_history_page(client):
+    r = client.get("/history")
+    assert r.status_code == 200
+    body = r.get_data(as_text=True)
+    assert "PAGE2" in body
+    assert "S1" in body
+    assert "古い履歴" not in body
+    r = client.get("/history?page=2")
+    assert r.status_code == 200
+    assert "PAGE2" not in r.get_data(as_text=True)
+
+def test_history_pagination(client):
+    # 別ユーザーに1ページ分 + 1件の履歴を作り、最も古い1件だけ料金を変えておく
+    s = get_session()
+    u = User(email="many@example.com", password_hash="x", balance_cents=0)
+    s.add(u)
+    s.commit()
+    s.add(Rental(user_id=u.id, battery_id=2, status="returned", price_cents=777))
+    s.add_all([
+        Rental(user_id=u.id, battery_id=2, status="returned", price_cents=10)
+        for _ in range(HISTORY_PAGE_SIZE)
+    ])
+    s.commit()
+    user_id = u.id
+    s.close()
+
+    with app.test_client() as other:
+        with other.session_transaction() as sess:
+            sess["user_id"] = user_id
+        body = other.get("/history").get_data(as_text=True)
+        assert body.count("返却済</span>") == HISTORY_PAGE_SIZE
+        assert "古い履歴" in body
+        assert "新しい履歴" not in body
+        assert "¥777" not in body
+
+        body = other.get("/history?page=2").get_data(as_text=True)
+        assert body.count("返却済</span>") == 1
+        assert "¥777" in body
+        assert "古い履歴" not in body
+        assert "新しい履歴" in body
+
+def test_history_out_of_range_page_redirects(client):
+    for page in ("0", str(HISTORY_MAX_PAGE + 1), "99999999999999999999"):
+        r = client.get(f"/history?page={page}")
+        assert r.status_code == 302
+        assert r.location.endswith("/history")
+
+def test_station_list_revalidates_with_etag(client):
+    r = client.get("/stations")
+    assert r.headers["Cache-Control"] == "private, no-cache"
+    etag = r.headers["ETag"]
+    r = client.get("/stations", headers={"If-None-Match": etag})
+    assert r.status_code == 304
+
+def test_register_rejects_duplicate_email(client):
+    form = {"email": "new@example.com", "password": "pw", "confirm_password": "pw"}
+    r = client.post("/register", data=form)
+    assert r.status_code == 302
+    r = client.post("/register", data=form)
+    assert r.status_code == 400
+    assert "既に登録されています" in r.get_data(as_text=True)
+
+def test_charge_rejects_oversized_amount(client):
+    r = client.post("/charge", data={"amount": "9" * 5000})
+    assert r.status_code == 302
+    assert r.location.endswith("/charge")
+
+def test_charge_adds_to_balance(client):
+    r = client.post("/charge", data={"amount": "250"})
+    assert r.status_code == 302
+    assert r.location.endswith("/home")
+    assert "¥5250" in client.get("/home").get_data(as_text=True)
+
+def test_ensure_indexes_adds_missing_composite_index(client):
+    # 既存 DB を想定：テーブルはあるが複合インデックスが無い状態から作り直せること
+    with engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_rentals_user_id_start_at"))
+    ensure_indexes()
+    ensure_indexes()
+    names = {ix["name"] for ix in inspect(engine).get_indexes("rentals")}
+    assert "ix_rentals_user_id_start_at" in names
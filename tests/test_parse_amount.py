@@ -0,0 +1,32 @@
+"""
+parse_amount（金額入力のパース）の pytest テスト
+"""
+from app import parse_amount, MAX_AMOUNT_DIGITS
+
+def test_accepts_integers():
+    assert parse_amount("500") == 500
+    assert parse_amount(" 500 ") == 500
+    assert parse_amount(500) == 500
+
+def test_accepts_full_width_digits():
+    assert parse_amount("１２３") == 123
+
+def test_rejects_non_integers():
+    assert parse_amount("²") is None
+    assert parse_amount(True) is None
+    assert parse_amount(False) is None
+    assert parse_amount(1.5) is None
+    assert parse_amount("1.5") is None
+    assert parse_amount("") is None
+    assert parse_amount(None) is None
+
+def test_negative_values():
+    # 文字列の負数は受け付けない。int の負数はそのまま返し、呼び出し側で弾く
+    assert parse_amount("-5") is None
+    assert parse_amount(-5) == -5
+
+def test_rejects_oversized_values():
+    assert parse_amount("9" * MAX_AMOUNT_DIGITS) == 10 ** MAX_AMOUNT_DIGITS - 1
+    assert parse_amount("9" * (MAX_AMOUNT_DIGITS + 1)) is None
+    assert parse_amount("9" * 5000) is None
+    assert parse_amount(10 ** MAX_AMOUNT_DIGITS) is None
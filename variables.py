@@ -26,9 +26,22 @@ load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///mobile_battery.db")
 
 # PostgreSQL用に接続文字列を修正（Renderなど）
-# postgres:// → postgresql:// の変換
-if DATABASE_URL.startswith("postgres://"):
-    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+# postgres:// / postgresql:// → postgresql+psycopg2:// の変換
+# ドライバを明示しないと SQLAlchemy 2.1 以降は psycopg（v3）を選ぶため、
+# requirements.txt の psycopg2 に固定する（gunicorn.conf.py の gevent 対応も psycopg2 前提）
+for prefix in ("postgres://", "postgresql://"):
+    if DATABASE_URL.startswith(prefix):
+        DATABASE_URL = DATABASE_URL.replace(prefix, "postgresql+psycopg2://", 1)
+        break
+
+# コネクションプール設定（PostgreSQL 等のサーバー型 DB のみ）
+# - DB_POOL_SIZE: 常に保持する接続数
+# - DB_MAX_OVERFLOW: 混雑時に一時的に追加で開ける接続数
+#   （ワーカー数 ×（POOL_SIZE + MAX_OVERFLOW）が DB の max_connections を超えないこと）
+# - DB_POOL_RECYCLE: この秒数を過ぎた接続は作り直す（LB やサーバー側の切断対策）
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
 
 # ============================================================
 # JWT認証設定
@@ -60,6 +73,14 @@ RENTAL_DEPOSIT_CENTS = int(os.getenv("RENTAL_DEPOSIT_CENTS", "500"))
 # 初回チャージボーナス（cents = 円）
 INITIAL_BALANCE_CENTS = int(os.getenv("INITIAL_BALANCE_CENTS", "0"))
 
+# ============================================================
+# キャッシュ設定
+# ============================================================
+# スタンド一覧（利用可能数）のキャッシュ保持秒数
+# 貸出・返却したプロセスではすぐ破棄されるが、他のワーカーには
+# この秒数だけ古い値が見える可能性がある
+STATION_CACHE_TTL_SECONDS = int(os.getenv("STATION_CACHE_TTL_SECONDS", "3"))
+
 # ============================================================
 # 設定内容の確認（デバッグ用）
 # ============================================================
@@ -72,3 +93,4 @@ if __name__ == "__main__":
     print(f"PRICE_PER_MINUTE_CENTS: {PRICE_PER_MINUTE_CENTS}円/分")
     print(f"RENTAL_DEPOSIT_CENTS: {RENTAL_DEPOSIT_CENTS}円")
     print(f"DEBUG_MODE: {DEBUG_MODE}")
+    print(f"STATION_CACHE_TTL_SECONDS: {STATION_CACHE_TTL_SECONDS}秒")